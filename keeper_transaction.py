@@ -0,0 +1,499 @@
+#!/usr/bin/python3
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pathlib  # python >= 3.5
+import tempfile
+import unittest
+
+
+# Batch changes to files in one directory (/etc/portage/package.use or output
+#  dir of portagekeeper), safe to use from several processes at once.
+#
+# Every caller appends its batch of changes to a journal file in target dir,
+#  then commits: whoever gets the lock first applies all batches queued so far
+#  (its own and those of other callers), reading and writing each file only
+#  once. Later callers find the journal empty and have nothing to do.
+# If a process dies during commit, the journal stays and is replayed by the
+#  next commit. Targets are resolved and stored in the journal before anything
+#  is written, and all operations give the same result when applied again.
+# Files are written to a temporary file first, which then replaces the original
+#  (when original is a symlink, its target is replaced). Lock file stays in
+#  target dir after commit; it is hidden, so portage does not read it.
+#
+# Journal records (dicts):
+#  {'op': 'write', 'file': name, 'text': str, 'base_hash': str}
+#     replace file contents; if several are queued for one file, the last one wins.
+#     'base_hash' is hash of file contents the text was made from; if file was changed
+#     since then by someone else, write is rejected (see Transaction.conflicts).
+#  {'op': 'use', 'file': name, 'atom': 'category/package', 'flags': [...],
+#   'bases': [name, ...], 'new_file': name}
+#     add flags to package line "<atom> <flags>" in file, flags of several records for
+#     the same atom are merged, comments and empty lines are kept. Existing lines are
+#     read from the first of 'bases' that exists (default: file itself). If 'new_file'
+#     is given and file already exists, new_file is written instead. Both are decided
+#     at commit time, under lock, so they see files written by other callers; 'use'
+#     records are applied on top of a 'write' to the same file, never dropped by it.
+
+log = logging.getLogger('Keeper.transaction')
+
+LOCK_FILE_NAME = '.portagekeeper.lock'
+JOURNAL_FILE_NAME = '.portagekeeper.journal'
+
+
+class DirLock:
+    """
+    Advisory exclusive lock on a directory, held on a lock file inside it.
+    Use as context manager.
+    """
+    def __init__(self, dirname: pathlib.Path):
+        self.lock_file = dirname.joinpath(LOCK_FILE_NAME)
+        self._fd = -1
+
+    def acquire(self):
+        self._fd = os.open(self.lock_file.as_posix(), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def release(self):
+        if self._fd >= 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = -1
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def read_text(filepath: pathlib.Path) -> str:
+    """
+    Returns file contents, empty string if file does not exist.
+    """
+    try:
+        with open(filepath.as_posix(), mode='rt', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return ''
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def is_atom_line(line: str) -> bool:
+    line = line.strip()
+    return (line != '') and (line[0] != '#')
+
+
+def merge_useflags(lines: list, use: dict) -> list:
+    """
+    Adds flags from use ({atom: [flags]}) to lines of package.use file.
+    Only missing flags are appended to lines of atoms already in file, a line
+    that already has all of them is kept as is; other lines are not touched.
+    New atoms are inserted before the first atom line that sorts after them
+    (with comments above it), so sorted file stays sorted.
+    """
+    ret = []
+    found = set()
+    for line in lines:
+        parts = line.split()
+        if is_atom_line(line) and (parts[0] in use.keys()) and (parts[0] not in found):
+            missing = []
+            for flag in use[parts[0]]:
+                if (flag not in parts[1:]) and (flag not in missing):
+                    missing.append(flag)
+            if len(missing) > 0:
+                line = '{} {}'.format(line.rstrip(), ' '.join(missing))
+            found.add(parts[0])
+        ret.append(line)
+    for atom in sorted(use.keys()):
+        if atom in found:
+            continue
+        new_line = '{} {}'.format(atom, ' '.join(sorted(set(use[atom]))))
+        pos = len(ret)
+        for i in range(len(ret)):
+            if is_atom_line(ret[i]) and (ret[i].strip() > new_line):
+                pos = i
+                # comments directly above belong to that atom
+                while (pos > 0) and ret[pos - 1].strip().startswith('#'):
+                    pos -= 1
+                break
+        ret.insert(pos, new_line)
+    return ret
+
+
+def write_file_atomic(filepath: pathlib.Path, text: str):
+    if filepath.is_symlink():
+        # replace symlink target, not symlink itself
+        filepath = pathlib.Path(os.path.realpath(filepath.as_posix()))
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    tmp = filepath.with_name('.' + filepath.name + '.tmp')
+    with open(tmp.as_posix(), mode='wt', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp.as_posix(), filepath.as_posix())
+
+
+class Transaction:
+    def __init__(self, dirname: pathlib.Path):
+        self.dirname = dirname
+        self.journal_file = dirname.joinpath(JOURNAL_FILE_NAME)
+        self.records = []
+        # id of own batch queued to journal and not committed yet
+        self.batch_id = ''
+        # set by commit(): own batch had been applied by a concurrent caller
+        self.applied_by_other = False
+        # set by commit(): names of files, writes to which were rejected,
+        #  because file was changed after text for it was made
+        self.conflicts = []
+
+    def write_file(self, filename: str, text: str, base_text: str = None):
+        """
+        base_text: contents of file that text was made from ('' if file did not exist);
+        if given and file is different at commit time, write is rejected.
+        """
+        rec = {'op': 'write', 'file': filename, 'text': text}
+        if base_text is not None:
+            rec['base_hash'] = text_hash(base_text)
+        self.records.append(rec)
+
+    def set_useflags(self, filename: str, atom: str, flags: list, bases: list = None, new_file: str = None):
+        rec = {'op': 'use', 'file': filename, 'atom': atom, 'flags': list(flags)}
+        if bases is not None:
+            rec['bases'] = list(bases)
+        if new_file is not None:
+            rec['new_file'] = new_file
+        self.records.append(rec)
+
+    def _append_batch(self):
+        """
+        Appends queued records as one batch to journal file. Must be called under lock.
+        """
+        if len(self.records) == 0:
+            return
+        self.batch_id = '{}-{}'.format(os.getpid(), os.urandom(8).hex())
+        for rec in self.records:
+            rec['batch'] = self.batch_id
+        with open(self.journal_file.as_posix(), mode='ab+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size > 0:
+                f.seek(size - 1)
+                if f.read(1) != b'\n':
+                    # torn tail of a batch, its writer died while writing it;
+                    #  cut it off, else it would be glued to our batch
+                    f.seek(0)
+                    data = f.read()
+                    keep = data.rfind(b'\n') + 1
+                    log.warning('Dropped partially written batch from journal {}: {!r}'.format(
+                        self.journal_file.as_posix(), data[keep:]))
+                    f.truncate(keep)
+            f.seek(0, os.SEEK_END)
+            f.write((json.dumps({'batch': self.batch_id, 'records': self.records}) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        self.records = []
+
+    def queue(self):
+        """
+        Appends queued records as one batch to journal file;
+        they will be applied by the next commit of any caller.
+        """
+        if len(self.records) == 0:
+            return
+        self.dirname.mkdir(parents=True, exist_ok=True)
+        with DirLock(self.dirname):
+            self._append_batch()
+
+    def read_journal(self) -> list:
+        """
+        Returns records of all batches in journal, in order.
+        """
+        ret = []
+        try:
+            with open(self.journal_file.as_posix(), mode='rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        batch = json.loads(line)
+                    except ValueError:
+                        log.warning('Skipped unreadable batch in journal {}: {!r}'.format(
+                            self.journal_file.as_posix(), line))
+                        continue
+                    ret.extend(batch.get('records', []))
+        except FileNotFoundError:
+            pass
+        return ret
+
+    def write_journal(self, records: list):
+        """
+        Replaces journal with one batch of (resolved) records. Must be called under lock.
+        """
+        tmp = self.journal_file.with_name(self.journal_file.name + '.tmp')
+        with open(tmp.as_posix(), mode='wt', encoding='utf-8') as f:
+            f.write(json.dumps({'batch': 'resolved', 'records': records}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp.as_posix(), self.journal_file.as_posix())
+
+    @staticmethod
+    def coalesce(records: list) -> dict:
+        """
+        Groups records by file, keeping order of files and of records.
+        """
+        ret = {}
+        for rec in records:
+            ret.setdefault(rec['file'], []).append(rec)
+        return ret
+
+    def resolve_targets(self, records: list) -> bool:
+        """
+        Decides for 'use' records which file to write (file or new_file) and which
+        file to read existing lines from, by files existing now. Called under lock,
+        before anything is written. Returns True if any record was changed.
+        """
+        changed = False
+        for rec in records:
+            if rec['op'] != 'use':
+                continue
+            if 'new_file' in rec:
+                new_file = rec.pop('new_file')
+                if self.dirname.joinpath(rec['file']).exists():
+                    rec['file'] = new_file
+                changed = True
+            if 'bases' in rec:
+                bases = rec.pop('bases')
+                rec['base'] = rec['file']
+                for name in bases:
+                    if self.dirname.joinpath(name).exists():
+                        rec['base'] = name
+                        break
+                changed = True
+        return changed
+
+    def apply_file(self, filename: str, records: list) -> bool:
+        """
+        Applies all records for one file. Returns True if file was written.
+        Rejected writes are added to self.conflicts.
+        """
+        filepath = self.dirname.joinpath(filename)
+        current = read_text(filepath)
+        writes = [rec for rec in records if rec['op'] == 'write']
+        uses = [rec for rec in records if rec['op'] == 'use']
+        text = None
+        if len(writes) > 0:
+            rec = writes[-1]
+            text = rec['text']
+            if ('base_hash' in rec) and (rec['base_hash'] != text_hash(current)):
+                # file was changed after the text was made from it; the text may
+                #  be already applied (commit is replayed), otherwise reject it
+                if self.merge_use(text, uses) != current:
+                    log.warning('Rejected write to {}: file was changed by someone else'.format(
+                        filepath.as_posix()))
+                    if rec.get('batch') == self.batch_id:
+                        self.conflicts.append(filename)
+                    text = None
+        if text is None:
+            if len(uses) == 0:
+                return False
+            text = read_text(self.dirname.joinpath(uses[0].get('base', filename)))
+        # flags already in file are kept, so batches committed one after
+        #  another by concurrent callers do not overwrite each other
+        text = self.merge_use(text, uses)
+        if filepath.is_file() and (current == text):
+            return False
+        write_file_atomic(filepath, text)
+        return True
+
+    @staticmethod
+    def merge_use(text: str, uses: list) -> str:
+        # atom -> merged flags, in order of appearance
+        use = {}
+        for rec in uses:
+            flags = use.setdefault(rec['atom'], [])
+            flags.extend(flag for flag in rec['flags'] if flag not in flags)
+        if len(use) == 0:
+            return text
+        return ''.join(line + '\n' for line in merge_useflags(text.splitlines(), use))
+
+    def commit(self) -> dict:
+        """
+        Adds own records to the journal, then applies everything in it in one pass.
+        Returns dict {file name: True if it is a new file, False if modified}
+        of files written by this call (may include other callers' changes).
+        """
+        written = {}
+        self.applied_by_other = False
+        self.conflicts = []
+        self.dirname.mkdir(parents=True, exist_ok=True)
+        with DirLock(self.dirname):
+            self._append_batch()
+            records = self.read_journal()
+            if (self.batch_id != '') and all(rec.get('batch') != self.batch_id for rec in records):
+                self.applied_by_other = True
+            if self.resolve_targets(records):
+                # so that replay after crash writes the same files
+                self.write_journal(records)
+            by_file = self.coalesce(records)
+            for filename, records in by_file.items():
+                is_new = not self.dirname.joinpath(filename).exists()
+                if self.apply_file(filename, records):
+                    written[filename] = is_new
+            # everything is applied, journal is no longer needed
+            try:
+                self.journal_file.unlink()
+            except FileNotFoundError:
+                pass
+        self.batch_id = ''
+        return written
+
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, filename: str) -> str:
+        with open(self.root.joinpath(filename).as_posix(), mode='rt', encoding='utf-8') as f:
+            return f.read()
+
+    def test_writeFile(self):
+        t = Transaction(self.root)
+        t.write_file('dev-qt', 'dev-qt/qtcore\n')
+        self.assertEqual(t.commit(), {'dev-qt': True})
+        self.assertEqual(self.read('dev-qt'), 'dev-qt/qtcore\n')
+        self.assertFalse(self.root.joinpath(JOURNAL_FILE_NAME).exists())
+        # same contents - nothing is written
+        t.write_file('dev-qt', 'dev-qt/qtcore\n')
+        self.assertEqual(t.commit(), {})
+
+    def test_mergeBatches(self):
+        with open(self.root.joinpath('media-libs').as_posix(), mode='wt', encoding='utf-8') as f:
+            f.write('# comment\nmedia-libs/mesa xa\nmedia-libs/libvpx postproc\n')
+        t1 = Transaction(self.root)
+        t1.set_useflags('media-libs', 'media-libs/mesa', ['xa', 'gles2'])
+        t1.queue()
+        t2 = Transaction(self.root)
+        t2.set_useflags('media-libs', 'media-libs/mesa', ['xa', 'vaapi'])
+        t2.set_useflags('media-libs', 'media-libs/flac', ['cxx'])
+        self.assertEqual(t2.commit(), {'media-libs': False})
+        self.assertEqual(self.read('media-libs'), 'media-libs/flac cxx\n'
+                                                  '# comment\n'
+                                                  'media-libs/mesa xa gles2 vaapi\n'
+                                                  'media-libs/libvpx postproc\n')
+        # batch of t1 was already applied by t2
+        self.assertEqual(t1.commit(), {})
+        # batch committed later is merged with the file, not replacing the line
+        t1.set_useflags('media-libs', 'media-libs/mesa', ['egl'])
+        self.assertEqual(t1.commit(), {'media-libs': False})
+        self.assertIn('media-libs/mesa xa gles2 vaapi egl\n', self.read('media-libs'))
+
+    def test_mergeKeepsLine(self):
+        lines = ['media-libs/mesa  xa gles2', 'media-libs/flac cxx']
+        self.assertEqual(merge_useflags(lines, {'media-libs/mesa': ['xa']}), lines)
+        self.assertEqual(merge_useflags(lines, {'media-libs/mesa': ['xa', 'egl']}),
+                         ['media-libs/mesa  xa gles2 egl', 'media-libs/flac cxx'])
+
+    def test_useBase(self):
+        with open(self.root.joinpath('media-libs').as_posix(), mode='wt', encoding='utf-8') as f:
+            f.write('media-libs/libvpx postproc\n')
+        t = Transaction(self.root)
+        t.set_useflags('media-libs', 'media-libs/mesa', ['xa'], bases=['._cfg0000_media-libs', 'media-libs'],
+                       new_file='media-libs.new')
+        self.assertEqual(t.commit(), {'media-libs.new': True})
+        self.assertEqual(self.read('media-libs.new'), 'media-libs/libvpx postproc\nmedia-libs/mesa xa\n')
+        self.assertEqual(self.read('media-libs'), 'media-libs/libvpx postproc\n')
+
+    def test_useAfterWrite(self):
+        t = Transaction(self.root)
+        t.write_file('media-libs', '# header\n\nmedia-libs/libvpx postproc\n# for mpv\nmedia-libs/mesa gles2\n')
+        t.set_useflags('media-libs', 'media-libs/mesa', ['xa'])
+        t.set_useflags('media-libs', 'media-libs/flac', ['cxx'])
+        t.commit()
+        self.assertEqual(self.read('media-libs'), '# header\n\nmedia-libs/flac cxx\nmedia-libs/libvpx postproc\n'
+                                                  '# for mpv\nmedia-libs/mesa gles2 xa\n')
+
+    def test_writeKeepsEarlierUse(self):
+        t1 = Transaction(self.root)
+        t1.set_useflags('media-libs', 'media-libs/flac', ['cxx'])
+        t1.queue()
+        t2 = Transaction(self.root)
+        t2.write_file('media-libs', 'media-libs/mesa xa\n')
+        t2.commit()
+        self.assertEqual(self.read('media-libs'), 'media-libs/flac cxx\nmedia-libs/mesa xa\n')
+
+    def test_writeConflict(self):
+        # text made from file, then file was changed by another caller before commit
+        base = 'media-libs/mesa xa\nmedia-libs/aaa x\n'
+        with open(self.root.joinpath('media-libs').as_posix(), mode='wt', encoding='utf-8') as f:
+            f.write(base)
+        sort = Transaction(self.root)
+        sort.write_file('media-libs', 'media-libs/aaa x\nmedia-libs/mesa xa\n', base)
+        other = Transaction(self.root)
+        other.set_useflags('media-libs', 'media-libs/flac', ['cxx'])
+        other.commit()
+        self.assertEqual(sort.commit(), {})
+        self.assertEqual(sort.conflicts, ['media-libs'])
+        self.assertIn('media-libs/flac cxx\n', self.read('media-libs'))
+        # made again from the current file, write is accepted
+        sort.write_file('media-libs', 'sorted\n', self.read('media-libs'))
+        self.assertEqual(sort.commit(), {'media-libs': False})
+        self.assertEqual(sort.conflicts, [])
+
+    def test_appliedByOther(self):
+        t1 = Transaction(self.root)
+        t1.write_file('dev-qt', 'dev-qt/qtcore\n')
+        t1.queue()
+        self.assertEqual(Transaction(self.root).commit(), {'dev-qt': True})
+        self.assertEqual(t1.commit(), {})
+        self.assertTrue(t1.applied_by_other)
+
+    def test_replayIsIdempotent(self):
+        t = Transaction(self.root)
+        t.set_useflags('cat', 'cat/pkg', ['x'], new_file='cat.new')
+        t.queue()
+        # commit crashed after writing the file, before removing journal
+        records = t.read_journal()
+        t.resolve_targets(records)
+        t.write_journal(records)
+        t.apply_file('cat', records)
+        self.assertEqual(Transaction(self.root).commit(), {})
+        self.assertFalse(self.root.joinpath('cat.new').exists())
+        self.assertEqual(self.read('cat'), 'cat/pkg x\n')
+
+    def test_keepSymlink(self):
+        self.root.joinpath('real').mkdir()
+        self.root.joinpath('dev-qt').symlink_to(self.root.joinpath('real', 'dev-qt'))
+        t = Transaction(self.root)
+        t.write_file('dev-qt', 'dev-qt/qtcore\n')
+        t.commit()
+        self.assertTrue(self.root.joinpath('dev-qt').is_symlink())
+        self.assertEqual(self.read('real/dev-qt'), 'dev-qt/qtcore\n')
+
+    def test_replayJournal(self):
+        t = Transaction(self.root)
+        t.write_file('dev-qt', 'dev-qt/qtcore\n')
+        t.queue()
+        # partially written batch of a dead process
+        with open(self.root.joinpath(JOURNAL_FILE_NAME).as_posix(), mode='at', encoding='utf-8') as f:
+            f.write('{"pid": 1, "rec')
+        self.assertEqual(Transaction(self.root).commit(), {'dev-qt': True})
+        self.assertEqual(self.read('dev-qt'), 'dev-qt/qtcore\n')
+
+    def test_tornTail(self):
+        # partially written batch of a dead process is the last thing in journal
+        with open(self.root.joinpath(JOURNAL_FILE_NAME).as_posix(), mode='wt', encoding='utf-8') as f:
+            f.write('{"pid": 1, "rec')
+        t = Transaction(self.root)
+        t.write_file('dev-qt', 'dev-qt/qtcore\n')
+        with self.assertLogs('Keeper.transaction', level='WARNING'):
+            self.assertEqual(t.commit(), {'dev-qt': True})
+        self.assertEqual(self.read('dev-qt'), 'dev-qt/qtcore\n')
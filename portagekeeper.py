@@ -4,8 +4,11 @@ import logging
 import pathlib  # python >= 3.5
 import re
 import sys
+import tempfile
 import unittest
 
+from keeper_transaction import Transaction, read_text
+
 
 # Requires python >= 3.5 because of newer pathlib API.
 
@@ -125,10 +128,182 @@ class PortageAtom:
                 self.package += p
 
 
+class PortageConfigEntry:
+    """
+    One atom line from package.* file, together with lines that were directly
+    above it: comments (and lines which could not be parsed) belong to the atom,
+    empty lines between them are kept only to reproduce the file as it was.
+    Line text is kept exactly as it was in the file, so parameters keep their
+    original spacing.
+    """
+    def __init__(self, atom: PortageAtom, line: str, leading_lines: list = None, source: str = ''):
+        self.atom = atom
+        self.line = line
+        self.leading_lines = leading_lines if leading_lines is not None else []
+        self.comments = [x for x in self.leading_lines if x.strip() != '']
+        self.source = source
+
+    def sort_key(self) -> str:
+        return str(self.atom).lower()
+
+
+class PortageConfigFile:
+    """
+    Lossless model of package.* file: header (comment block at the top of file,
+    separated from the rest by empty line), list of PortageConfigEntry and
+    trailer (comment lines after the last atom).
+    """
+    def __init__(self):
+        self.header = []
+        self.entries = []
+        self.trailer = []
+        self.invalid_lines = []
+
+    def parse(self, text: str, source: str = ''):
+        pending = []
+        for line in text.splitlines():
+            sline = line.strip()
+            if (sline == '') or (sline[0] == '#'):
+                pending.append(line)
+                continue
+            patom = PortageAtom(sline)
+            if patom.is_invalid():
+                # keep it as is, so it will not be lost
+                self.invalid_lines.append(line)
+                pending.append(line)
+                continue
+            if len(self.entries) == 0:
+                # everything up to the last empty line before the first atom is header
+                for i in range(len(pending) - 1, -1, -1):
+                    if pending[i].strip() == '':
+                        self.header = pending[:i + 1]
+                        pending = pending[i + 1:]
+                        break
+            self.entries.append(PortageConfigEntry(patom, line, pending, source))
+            pending = []
+        self.trailer = pending
+
+    @staticmethod
+    def render(header: list, entries: list, trailer: list, keep_empty_lines: bool = True) -> str:
+        """
+        With keep_empty_lines=False empty lines between entries are dropped,
+        they only make sense in the order of the file they came from.
+        """
+        lines = list(header)
+        for entry in entries:
+            if keep_empty_lines:
+                comments = entry.leading_lines
+            else:
+                comments = entry.comments
+            if len(lines) == 0:
+                # do not start file with empty lines
+                while (len(comments) > 0) and (comments[0].strip() == ''):
+                    comments = comments[1:]
+            lines.extend(comments)
+            lines.append(entry.line)
+        lines.extend(trailer)
+        if len(lines) == 0:
+            return ''
+        return '\n'.join(lines) + '\n'
+
+
+class SavedConfig:
+    """
+    Contents of /etc/portage/savedconfig/<category>/<package>-<version> file:
+    list of lines in original order plus a set of them for fast lookups.
+    """
+    kconfig_re = re.compile(r'^(?:# )?(CONFIG_[A-Za-z0-9_]+)(?:=| is not set$)')
+    # <package>-<version>[-r<revision>], version as in PMS
+    name_re = re.compile(r'^(.+)-([0-9]+(?:\.[0-9]+)*[a-z]?(?:_(?:alpha|beta|pre|rc|p)[0-9]*)*(?:-r[0-9]+)?)$')
+
+    @staticmethod
+    def split_name(name: str) -> tuple:
+        """
+        Splits savedconfig file name to (package, version): version starts after
+        the last '-' followed by a valid version, with optional -rN.
+        Returns ('', '') if name has no version.
+        """
+        m = SavedConfig.name_re.match(name)
+        if m is None:
+            return '', ''
+        return m.group(1), m.group(2)
+
+    def __init__(self, lines: list = None):
+        self.lines = []
+        self.entries = set()
+        if lines is not None:
+            self.set_lines(lines)
+
+    def set_lines(self, lines: list):
+        self.lines = [line.rstrip() for line in lines]
+        self.entries = set(self.lines)
+
+    def load(self, filepath: pathlib.Path):
+        with open(filepath.as_posix(), mode='rt', encoding='utf-8') as f:
+            self.set_lines(f.read().splitlines())
+
+    def to_str(self) -> str:
+        if len(self.lines) == 0:
+            return ''
+        return '\n'.join(self.lines) + '\n'
+
+    def diff(self, other: 'SavedConfig') -> tuple:
+        """
+        Returns tuple (added, removed): lists of entries that are present
+        only in other or only in self, each in its original order.
+        """
+        added = [line for line in other.lines if line not in self.entries]
+        removed = [line for line in self.lines if line not in other.entries]
+        return added, removed
+
+    @staticmethod
+    def entry_key(line: str) -> str:
+        """
+        For kconfig lines ("CONFIG_X=y", "# CONFIG_X is not set") returns
+        option name, so that both forms of one option match; otherwise line itself.
+        """
+        m = SavedConfig.kconfig_re.match(line)
+        if m is not None:
+            return m.group(1)
+        return line
+
+    def carry_over(self, new_upstream: 'SavedConfig', old_upstream: 'SavedConfig') -> 'SavedConfig':
+        """
+        Applies local changes made to this (old) savedconfig, compared to old upstream
+        list, to the new upstream list, keeping upstream order: local removals are dropped,
+        locally changed kconfig options replace upstream lines of the same option,
+        other local additions are appended at the end.
+        """
+        local_added, local_removed = old_upstream.diff(self)
+        removals = set(local_removed)
+        # option name -> our line, for kconfig options we changed
+        replacements = {}
+        for line in local_added:
+            key = self.entry_key(line)
+            if key != line:
+                replacements[key] = line
+        lines = []
+        replaced = set()
+        for line in new_upstream.lines:
+            key = self.entry_key(line)
+            if key in replacements:
+                if key not in replaced:
+                    lines.append(replacements[key])
+                    replaced.add(key)
+                continue
+            if line in removals:
+                continue
+            lines.append(line)
+        lines.extend(line for line in local_added
+                     if (line not in new_upstream.entries) and (self.entry_key(line) not in replaced))
+        return SavedConfig(lines)
+
+
 class KeeperConfig:
     def __init__(self):
         self.PORTAGE_ETC_DIR = '/etc/portage'
         self.OUTPUT_DIR = './keeper_out'
+        self.UPSTREAM_SAVEDCONFIG_DIR = ''
 
 
 class Keeper:
@@ -150,19 +325,28 @@ class Keeper:
         ap.add_argument('--portage_etc_dir', action='store', nargs='?', type=str, default='/etc/portage',
                         required=False, help='Location of portage configuration, default: /etc/portage')
         ap.add_argument('--outdir', action='store', nargs='?', type=str, default='./keeper_out',
-                        required=False, help="Where to put result files for action 'sort'")
+                        required=False, help="Where to put result files for actions 'sort' and 'savedconfig'. "
+                        "Files are replaced atomically (symlinks are kept, their targets are replaced); "
+                        "a hidden .portagekeeper.lock file is kept in output directories to "
+                        "serialize concurrent runs")
+        ap.add_argument('--upstream_savedconfig_dir', action='store', nargs='?', type=str, default='',
+                        required=False, help="For action 'savedconfig': directory with unmodified upstream "
+                        "lists, laid out as <category>/<package>-<version>, like savedconfig itself; must "
+                        "have lists for both old (already saved) and new versions")
         ap.add_argument('--debug', action='store_true', help='Enable more debug output')
         ap.add_argument('action', action='store', nargs=1, metavar='action',
-                        choices=['sort', 'verify', 'mask', 'unmask', 'unkeyword'],
+                        choices=['sort', 'verify', 'mask', 'unmask', 'unkeyword', 'savedconfig'],
                         help="Action to perform. Possible actions:"
                         " 'sort': scan all files in portage dir and bring them to order. "
                         " 'verify': check that package versions mentioned really exist. "
+                        " 'savedconfig': move local changes of savedconfig files to new package versions. "
                         )
         args = ap.parse_args()
         # print(args)
 
         self.config.PORTAGE_ETC_DIR = args.portage_etc_dir
         self.config.OUTPUT_DIR = args.outdir
+        self.config.UPSTREAM_SAVEDCONFIG_DIR = args.upstream_savedconfig_dir
         self._debug = args.debug
         if args.action is not None:
             self.action = args.action[0]
@@ -193,6 +377,8 @@ class Keeper:
             self.error_exit('"action" should be specified. See {} --help\n'.format(sys.argv[0]))
         if self.action == 'sort':
             self.run_sort()
+        elif self.action == 'savedconfig':
+            self.run_savedconfig()
         else:
             self.error_exit("Action '{}' is not implemented.".format(self.action))
 
@@ -204,12 +390,21 @@ class Keeper:
         self.run_sort_directory(p.joinpath('package.mask'))
         self.run_sort_directory(p.joinpath('package.unmask'))
 
-    def run_sort_directory(self, dirname: pathlib.Path):
+    def run_sort_directory(self, dirname: pathlib.Path, attempts: int = 3) -> int:
+        """
+        Returns number of files written. Output files which already
+        have the same contents are not rewritten. If some file was changed
+        by someone else while sorting, directory is sorted again, at most
+        attempts times in total.
+        """
         if not dirname.is_dir():
             self.log.error('Cannot open directory: {}'.format(dirname.as_posix()))
-            return
+            return 0
 
+        # category -> [header lines, entries, trailer lines]
         category_dict = {}
+        # file name -> contents as it was read
+        source_texts = {}
 
         self.log.info('Processing dir: {}'.format(dirname.as_posix()))
         filelist = sorted(dirname.glob('*'))
@@ -217,23 +412,33 @@ class Keeper:
             if filepath.is_symlink():
                 self.log.debug('  Skipped symlink: {}'.format(filepath.as_posix()))
                 continue
+            if filepath.name.startswith('.'):
+                # portage ignores hidden files too; these are ._cfg* files and our journal
+                self.log.debug('  Skipped hidden file: {}'.format(filepath.as_posix()))
+                continue
             self.log.debug('  Reading: {}'.format(filepath.as_posix()))
             try:
                 with open(filepath.as_posix(), mode='rt', encoding='utf-8') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line == '': continue
-                        if line[0] == '#': continue
-                        patom = PortageAtom(line)
-                        if patom.is_invalid():
-                            # invalid atom or parse error
-                            self.log.error('Failed to parse line: [{}] as package atom.'.format(line))
-                        else:
-                            if not patom.category in category_dict.keys():
-                                category_dict[patom.category] = []
-                            category_dict[patom.category].append(patom)
+                    source_texts[filepath.name] = f.read()
+                pfile = PortageConfigFile()
+                pfile.parse(source_texts[filepath.name], filepath.name)
             except IOError:
                 self.log.exception('I/O error reading {}'.format(filepath.as_posix()))
+                continue
+            for line in pfile.invalid_lines:
+                # invalid atom or parse error
+                self.log.error('Failed to parse line: [{}] as package atom.'.format(line.strip()))
+            if len(pfile.entries) == 0:
+                if len(pfile.header) + len(pfile.trailer) > 0:
+                    self.log.warning('  No atoms in {}, its comments are dropped'.format(filepath.as_posix()))
+                continue
+            for entry in pfile.entries:
+                if not entry.atom.category in category_dict.keys():
+                    category_dict[entry.atom.category] = [[], [], []]
+                category_dict[entry.atom.category][1].append(entry)
+            # header goes to the file of the first atom, trailer - to the file of the last one
+            category_dict[pfile.entries[0].atom.category][0].extend(pfile.header)
+            category_dict[pfile.entries[-1].atom.category][2].extend(pfile.trailer)
 
         # make sure output directory exists
         last_part = dirname.parts[len(dirname.parts) -1]
@@ -244,18 +449,138 @@ class Keeper:
         if not outdir.exists():
             outdir.mkdir(parents=True, exist_ok=True)
 
-        # output:
+        # output: all files are written at once, under lock on output dir
+        txn = Transaction(outdir)
+        in_place = outdir.resolve() == dirname.resolve()
+        num_written = 0
+        num_unchanged = 0
         ckeys = sorted(category_dict.keys())
         for cat in ckeys:
             outfile = outdir.joinpath(cat)
+            header, entries, trailer = category_dict[cat]
+            entries = sorted(entries, key=PortageConfigEntry.sort_key)
+            # entries from several files: their empty lines would be scattered between unrelated atoms
+            single_source = len(set(entry.source for entry in entries)) == 1
+            text = PortageConfigFile.render(header, entries, trailer, single_source)
+            # when sorting in place, output file is also input: it must not change
+            #  between reading it and writing result
+            if in_place and (cat in source_texts.keys()):
+                base_text = source_texts[cat]
+            else:
+                base_text = read_text(outfile)
+            if outfile.is_file() and (base_text == text):
+                self.log.debug('  Unchanged: {}'.format(outfile.as_posix()))
+                num_unchanged += 1
+                continue
             self.log.debug('  Writing {}...'.format(outfile.as_posix()))
+            txn.write_file(cat, text, base_text)
+            num_written += 1
+        self.commit_transaction(txn)
+        num_written -= len(txn.conflicts)
+        self.log.info('  Files written: {}, unchanged: {}'.format(num_written, num_unchanged))
+        if len(txn.conflicts) > 0:
+            if attempts > 1:
+                self.log.warning('  Files changed while sorting: {}, sorting again'.format(', '.join(txn.conflicts)))
+                return num_written + self.run_sort_directory(dirname, attempts - 1)
+            self.log.error('  Files changed while sorting, not written: {}'.format(', '.join(txn.conflicts)))
+        return num_written
+
+    def commit_transaction(self, txn: Transaction):
+        try:
+            txn.commit()
+        except (IOError, ValueError):
+            self.log.exception('Failed to write output files to: {}'.format(txn.dirname.as_posix()))
+
+    @staticmethod
+    def version_key(version: str) -> tuple:
+        return tuple(int(x) for x in re.findall(r'[0-9]+', version))
+
+    def scan_savedconfig_dir(self, dirname: pathlib.Path) -> dict:
+        """
+        Returns dict {'category/package': {version: path}}
+        """
+        ret = {}
+        for filepath in sorted(dirname.glob('*/*')):
+            if not filepath.is_file():
+                continue
+            package, version = SavedConfig.split_name(filepath.name)
+            if version == '':
+                self.log.warning('  Skipped file without version: {}'.format(filepath.as_posix()))
+                continue
+            pn = '{}/{}'.format(filepath.parent.name, package)
+            if not pn in ret.keys():
+                ret[pn] = {}
+            ret[pn][version] = filepath
+        return ret
+
+    def run_savedconfig(self) -> int:
+        """
+        For every package in upstream savedconfig dir, takes its newest version and
+        the newest older version from /etc/portage/savedconfig, and writes savedconfig
+        for the new version with the same local changes to output dir.
+        Returns number of files written.
+        """
+        if self.config.UPSTREAM_SAVEDCONFIG_DIR == '':
+            self.error_exit("Action 'savedconfig' requires --upstream_savedconfig_dir")
+        saved_dir = pathlib.Path(self.config.PORTAGE_ETC_DIR).joinpath('savedconfig')
+        upstream_dir = pathlib.Path(self.config.UPSTREAM_SAVEDCONFIG_DIR)
+        outdir = pathlib.Path(self.config.OUTPUT_DIR).joinpath('savedconfig')
+        self.log.info('Will put resulting files to: {}'.format(outdir.as_posix()))
+
+        saved = self.scan_savedconfig_dir(saved_dir)
+        upstream = self.scan_savedconfig_dir(upstream_dir)
+        txn = Transaction(outdir)
+        num_written = 0
+        for pn in sorted(upstream.keys()):
+            new_ver = max(upstream[pn].keys(), key=self.version_key)
+            old_versions = [v for v in saved.get(pn, {}).keys()
+                            if self.version_key(v) < self.version_key(new_ver)]
+            if len(old_versions) == 0:
+                self.log.info('{}: no older savedconfig, nothing to carry over'.format(pn))
+                continue
+            old_ver = max(old_versions, key=self.version_key)
             try:
-                with open(outfile.as_posix(), mode='wt', encoding='utf-8') as fo:
-                    palist = sorted(category_dict[cat], key=lambda x: str(x).lower())
-                    for patom in palist:
-                        fo.write(patom.get_full_str() + '\n')
+                old_saved = SavedConfig()
+                old_saved.load(saved[pn][old_ver])
+                new_upstream = SavedConfig()
+                new_upstream.load(upstream[pn][new_ver])
+                old_upstream = None
+                if old_ver in upstream[pn].keys():
+                    old_upstream = SavedConfig()
+                    old_upstream.load(upstream[pn][old_ver])
             except IOError:
-                self.log.exception('Failed to write output file: {}'.format(outfile.as_posix()))
+                self.log.exception('{}: I/O error reading savedconfig'.format(pn))
+                continue
+            if old_upstream is None:
+                # without it local removals can not be told apart from entries new upstream added
+                self.log.error('{}: no upstream list for {} in {}, skipped'.format(
+                    pn, old_ver, upstream_dir.as_posix()))
+                continue
+
+            added, removed = old_saved.diff(new_upstream)
+            result = old_saved.carry_over(new_upstream, old_upstream)
+            self.log.info('{}: {} -> {}: new entries {}, dropped entries {}; result has {} of {} lines'.format(
+                pn, old_ver, new_ver, len(added), len(removed), len(result.lines), len(new_upstream.lines)))
+            for line in added:
+                self.log.debug('  + {}'.format(line))
+            for line in removed:
+                self.log.debug('  - {}'.format(line))
+
+            # same file name as upstream one, portage looks for exactly it
+            outname = '{}/{}'.format(upstream[pn][new_ver].parent.name, upstream[pn][new_ver].name)
+            outfile = outdir.joinpath(outname)
+            text = result.to_str()
+            base_text = read_text(outfile)
+            if outfile.is_file() and (base_text == text):
+                self.log.debug('  Unchanged: {}'.format(outfile.as_posix()))
+                continue
+            self.log.debug('  Writing {}...'.format(outfile.as_posix()))
+            txn.write_file(outname, text, base_text)
+            num_written += 1
+        self.commit_transaction(txn)
+        if len(txn.conflicts) > 0:
+            self.log.error('Files changed by someone else, not written: {}'.format(', '.join(txn.conflicts)))
+        return num_written - len(txn.conflicts)
 
 
 class PortageAtomTest(unittest.TestCase):
@@ -471,6 +796,225 @@ class PortageAtomTest(unittest.TestCase):
             i += 1
 
 
+class PortageConfigFileTest(unittest.TestCase):
+    def setUp(self):
+        self.sorted_text = ('# header comment\n'
+                            '\n'
+                            'kde-apps/baloo-widgets\n'
+                            '\n'
+                            'kde-apps/libkipi\n'
+                            '#=kde-apps/libkonq-9999 **\n'
+                            '<=kde-apps/libkonq-15.12.2   ~amd64\n'
+                            '# trailing comment\n')
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_keeper(self) -> 'Keeper':
+        keeper = Keeper()
+        keeper.config.OUTPUT_DIR = pathlib.Path(self.tmpdir.name).joinpath('out').as_posix()
+        keeper.log = logging.getLogger('KeeperTest')
+        return keeper
+
+    def test_parse(self):
+        pfile = PortageConfigFile()
+        pfile.parse(self.sorted_text)
+        self.assertEqual(pfile.header, ['# header comment', ''])
+        self.assertEqual(len(pfile.entries), 3)
+        self.assertEqual(pfile.entries[1].comments, [])
+        self.assertEqual(pfile.entries[1].leading_lines, [''])
+        self.assertEqual(pfile.entries[2].comments, ['#=kde-apps/libkonq-9999 **'])
+        self.assertEqual(pfile.entries[2].line, '<=kde-apps/libkonq-15.12.2   ~amd64')
+        self.assertEqual(pfile.trailer, ['# trailing comment'])
+
+    def test_roundTrip(self):
+        pfile = PortageConfigFile()
+        pfile.parse(self.sorted_text)
+        entries = sorted(pfile.entries, key=PortageConfigEntry.sort_key)
+        self.assertEqual(PortageConfigFile.render(pfile.header, entries, pfile.trailer), self.sorted_text)
+
+    def test_commentMovesWithAtom(self):
+        pfile = PortageConfigFile()
+        pfile.parse('kde-apps/libkipi\n# needed for dolphin\nkde-apps/baloo-widgets\n')
+        entries = sorted(pfile.entries, key=PortageConfigEntry.sort_key)
+        self.assertEqual(PortageConfigFile.render(pfile.header, entries, pfile.trailer),
+                         '# needed for dolphin\nkde-apps/baloo-widgets\nkde-apps/libkipi\n')
+
+    def test_mergedFilesDropEmptyLines(self):
+        indir = pathlib.Path(self.tmpdir.name).joinpath('package.accept_keywords')
+        indir.mkdir()
+        with open(indir.joinpath('dolphin').as_posix(), mode='wt', encoding='utf-8') as f:
+            f.write('kde-apps/dolphin\n\n# needed by dolphin\nkde-apps/baloo-widgets\n')
+        with open(indir.joinpath('kde-apps').as_posix(), mode='wt', encoding='utf-8') as f:
+            f.write('kde-apps/ark\n\nkde-apps/kate\n')
+        keeper = self.make_keeper()
+        keeper.run_sort_directory(indir)
+        outfile = pathlib.Path(keeper.config.OUTPUT_DIR).joinpath('package.accept_keywords', 'kde-apps')
+        with open(outfile.as_posix(), mode='rt', encoding='utf-8') as f:
+            self.assertEqual(f.read(), 'kde-apps/ark\n'
+                                       '# needed by dolphin\n'
+                                       'kde-apps/baloo-widgets\n'
+                                       'kde-apps/dolphin\n'
+                                       'kde-apps/kate\n')
+
+    def test_sortedDirectoryIsNoop(self):
+        indir = pathlib.Path(self.tmpdir.name).joinpath('package.accept_keywords')
+        indir.mkdir()
+        with open(indir.joinpath('kde-apps').as_posix(), mode='wt', encoding='utf-8') as f:
+            f.write(self.sorted_text)
+        keeper = self.make_keeper()
+        self.assertEqual(keeper.run_sort_directory(indir), 1)
+        outfile = pathlib.Path(keeper.config.OUTPUT_DIR).joinpath('package.accept_keywords', 'kde-apps')
+        with open(outfile.as_posix(), mode='rt', encoding='utf-8') as f:
+            self.assertEqual(f.read(), self.sorted_text)
+        self.assertEqual(keeper.run_sort_directory(indir), 0)
+        # sorting in place
+        keeper.config.OUTPUT_DIR = self.tmpdir.name
+        self.assertEqual(keeper.run_sort_directory(indir), 0)
+
+
+class SortRaceTest(unittest.TestCase):
+    class RacingKeeper(Keeper):
+        """
+        Keeper, which lets use_fixer-like transaction commit
+        between reading input files and committing sort result.
+        """
+        def commit_transaction(self, txn: Transaction):
+            if self.race:
+                self.race = False
+                other = Transaction(txn.dirname)
+                other.set_useflags('media-libs', 'media-libs/flac', ['cxx'])
+                other.commit()
+            super().commit_transaction(txn)
+
+    def test_sortInPlace(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            indir = pathlib.Path(tmpdir).joinpath('package.use')
+            indir.mkdir()
+            with open(indir.joinpath('media-libs').as_posix(), mode='wt', encoding='utf-8') as f:
+                f.write('media-libs/mesa xa\nmedia-libs/aaa x\n')
+            keeper = self.RacingKeeper()
+            keeper.race = True
+            keeper.log = logging.getLogger('KeeperTest')
+            keeper.config.OUTPUT_DIR = tmpdir
+            keeper.run_sort_directory(indir)
+            with open(indir.joinpath('media-libs').as_posix(), mode='rt', encoding='utf-8') as f:
+                self.assertEqual(f.read(), 'media-libs/aaa x\nmedia-libs/flac cxx\nmedia-libs/mesa xa\n')
+
+
+class SavedConfigTest(unittest.TestCase):
+    def setUp(self):
+        self.old_upstream = SavedConfig(['a.bin', 'b.bin', 'c.bin', 'd.bin'])
+        self.old_saved = SavedConfig(['a.bin', 'c.bin', 'local.bin'])
+        self.new_upstream = SavedConfig(['e.bin', 'd.bin', 'c.bin', 'b.bin'])
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_diff(self):
+        added, removed = self.old_saved.diff(self.new_upstream)
+        self.assertEqual(added, ['e.bin', 'd.bin', 'b.bin'])
+        self.assertEqual(removed, ['a.bin', 'local.bin'])
+
+    def test_carryOver(self):
+        result = self.old_saved.carry_over(self.new_upstream, self.old_upstream)
+        self.assertEqual(result.lines, ['e.bin', 'c.bin', 'local.bin'])
+
+    def test_carryOverKconfig(self):
+        busybox = pathlib.Path(__file__).resolve().parent.joinpath(
+            'tests', 'portage', 'savedconfig', 'sys-apps', 'busybox-1.25.1')
+        old_upstream = SavedConfig()
+        old_upstream.load(busybox)
+        changes = {
+            'CONFIG_DESKTOP=y': '# CONFIG_DESKTOP is not set',
+            '# CONFIG_USE_PORTABLE_CODE is not set': 'CONFIG_USE_PORTABLE_CODE=y',
+        }
+        old_saved = SavedConfig([changes.get(line, line) for line in old_upstream.lines])
+        new_lines = []
+        for line in old_upstream.lines:
+            new_lines.append(line.replace('# Busybox version: 1.25.1', '# Busybox version: 1.26.2'))
+            if line == 'CONFIG_EXTRA_COMPAT=y':
+                new_lines.append('CONFIG_NEW_OPTION=y')
+        new_upstream = SavedConfig(new_lines)
+        result = old_saved.carry_over(new_upstream, old_upstream)
+        # same structure as new upstream ("#" and empty lines included), with our options
+        self.assertEqual(result.lines, [changes.get(line, line) for line in new_lines])
+        self.assertIn('CONFIG_NEW_OPTION=y', result.entries)
+        self.assertEqual(result.lines.count('#'), new_lines.count('#'))
+
+    def make_keeper(self, files: dict) -> Keeper:
+        """
+        files: {path relative to temporary dir: SavedConfig}; etc/savedconfig is
+        portage one, upstream/ has upstream lists, output goes to out/.
+        """
+        root = pathlib.Path(self.tmpdir.name)
+        for relpath, sc in files.items():
+            filepath = root.joinpath(relpath)
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            with open(filepath.as_posix(), mode='wt', encoding='utf-8') as f:
+                f.write(sc.to_str())
+        keeper = Keeper()
+        keeper.log = logging.getLogger('KeeperTest')
+        keeper.config.PORTAGE_ETC_DIR = root.joinpath('etc').as_posix()
+        keeper.config.UPSTREAM_SAVEDCONFIG_DIR = root.joinpath('upstream').as_posix()
+        keeper.config.OUTPUT_DIR = root.joinpath('out').as_posix()
+        return keeper
+
+    def read_output(self, relpath: str) -> list:
+        result = SavedConfig()
+        result.load(pathlib.Path(self.tmpdir.name).joinpath('out', 'savedconfig', relpath))
+        return result.lines
+
+    def test_runSavedconfigWithoutOldUpstream(self):
+        keeper = self.make_keeper({
+            'etc/savedconfig/sys-kernel/linux-firmware-20161205': self.old_saved,
+            'upstream/sys-kernel/linux-firmware-20170314': self.new_upstream,
+        })
+        self.assertEqual(keeper.run_savedconfig(), 0)
+        self.assertFalse(pathlib.Path(self.tmpdir.name).joinpath(
+            'out', 'savedconfig', 'sys-kernel', 'linux-firmware-20170314').exists())
+
+    def test_runSavedconfig(self):
+        firmware = pathlib.Path(__file__).resolve().parent.joinpath(
+            'tests', 'portage', 'savedconfig', 'sys-kernel', 'linux-firmware-20161205')
+        old_upstream = SavedConfig()
+        old_upstream.load(firmware)
+        old_saved = SavedConfig([line for line in old_upstream.lines if not line.startswith('amdgpu/')])
+        new_upstream = SavedConfig(['new/firmware.bin'] + list(reversed(old_upstream.lines)))
+        keeper = self.make_keeper({
+            'etc/savedconfig/sys-kernel/linux-firmware-20161205': old_saved,
+            'upstream/sys-kernel/linux-firmware-20161205': old_upstream,
+            'upstream/sys-kernel/linux-firmware-20170314': new_upstream,
+        })
+        self.assertEqual(keeper.run_savedconfig(), 1)
+        self.assertEqual(self.read_output('sys-kernel/linux-firmware-20170314'),
+                         ['new/firmware.bin'] + list(reversed(old_saved.lines)))
+        self.assertEqual(keeper.run_savedconfig(), 0)
+
+    def test_splitName(self):
+        self.assertEqual(SavedConfig.split_name('linux-firmware-20161205'), ('linux-firmware', '20161205'))
+        self.assertEqual(SavedConfig.split_name('raspberrypi-firmware-1.20190215'),
+                         ('raspberrypi-firmware', '1.20190215'))
+        self.assertEqual(SavedConfig.split_name('r8168-8.045-r1'), ('r8168', '8.045-r1'))
+        self.assertEqual(SavedConfig.split_name('busybox-1.25.1_rc2'), ('busybox', '1.25.1_rc2'))
+        self.assertEqual(SavedConfig.split_name('busybox'), ('', ''))
+
+    def test_runSavedconfigNames(self):
+        keeper = self.make_keeper({
+            'etc/savedconfig/sys-boot/raspberrypi-firmware-1.20190215': self.old_saved,
+            'upstream/sys-boot/raspberrypi-firmware-1.20190215': self.old_upstream,
+            'upstream/sys-boot/raspberrypi-firmware-1.20190925': self.new_upstream,
+            'etc/savedconfig/net-misc/r8168-8.045': self.old_saved,
+            'upstream/net-misc/r8168-8.045': self.old_upstream,
+            'upstream/net-misc/r8168-8.046-r1': self.new_upstream,
+        })
+        self.assertEqual(keeper.run_savedconfig(), 2)
+        expected = ['e.bin', 'c.bin', 'local.bin']
+        self.assertEqual(self.read_output('sys-boot/raspberrypi-firmware-1.20190925'), expected)
+        self.assertEqual(self.read_output('net-misc/r8168-8.046-r1'), expected)
+
 def main():
     keeper = Keeper()
     keeper.run()
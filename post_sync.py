@@ -0,0 +1,367 @@
+#!/usr/bin/python3
+import argparse
+import concurrent.futures
+import configparser
+import hashlib
+import json
+import logging
+import os
+import pathlib  # python >= 3.5
+import shlex
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+# Replacement for repo.postsync.d/regencache + postsync.d/* hooks chain:
+#  instead of running egencache for every repository, one after another,
+#  remember a fingerprint of each repository tree and run the command
+#  only for repositories that really changed since the last run, in parallel.
+
+DEFAULT_COMMAND = 'egencache --repo={name} --jobs={jobs} --update --update-use-local-desc'
+DEFAULT_SORT_COMMAND = '{python} {keeper} --portage_etc_dir={portage_etc_dir} --outdir={outdir} sort'
+
+
+class RepoInfo:
+    def __init__(self, name: str, location: str):
+        self.name = name
+        self.location = location
+
+    def __str__(self):
+        return '{} ({})'.format(self.name, self.location)
+
+
+def read_repos_conf(repos_conf: pathlib.Path) -> list:
+    """
+    Reads repos.conf, which can be either a single file or a directory
+    with *.conf files. Returns list of RepoInfo, in order of appearance.
+    """
+    cp = configparser.ConfigParser(interpolation=None)
+    if repos_conf.is_dir():
+        files = [f.as_posix() for f in sorted(repos_conf.glob('*')) if f.is_file()]
+    else:
+        files = [repos_conf.as_posix()]
+    cp.read(files, encoding='utf-8')
+    ret = []
+    for section in cp.sections():
+        location = cp.get(section, 'location', fallback='').strip()
+        if location == '':
+            continue
+        ret.append(RepoInfo(section, location))
+    return ret
+
+
+def git_fingerprint(location: pathlib.Path) -> str:
+    """
+    Returns 'git:<sha>' of repository HEAD, or empty string if
+    location is not a git checkout (or git is not available).
+    """
+    if not location.joinpath('.git').exists():
+        return ''
+    try:
+        out = subprocess.check_output(['git', '-C', location.as_posix(), 'rev-parse', 'HEAD'],
+                                      stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+    return 'git:' + out.decode('utf-8').strip()
+
+
+def mtime_fingerprint(location: pathlib.Path) -> str:
+    """
+    Returns 'mtime:<digest>' over modification times of all directories
+    in the tree. Syncing (rsync or other) adds, removes or renames files,
+    which updates mtime of their parent directory, so there is no need
+    to stat every single file in a tree.
+    """
+    h = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(location.as_posix()):
+        dirnames.sort()
+        try:
+            st = os.stat(dirpath)
+        except OSError:
+            continue
+        h.update('{}\0{}\n'.format(os.path.relpath(dirpath, location.as_posix()),
+                                   st.st_mtime_ns).encode('utf-8', 'surrogateescape'))
+    return 'mtime:' + h.hexdigest()
+
+
+def repo_fingerprint(location: pathlib.Path) -> str:
+    if not location.is_dir():
+        return ''
+    fp = git_fingerprint(location)
+    if fp == '':
+        fp = mtime_fingerprint(location)
+    return fp
+
+
+def format_command(template: str, **kwargs) -> list:
+    """
+    Splits command template shell-like and substitutes {placeholders}
+    in every argument separately, so values with spaces stay intact.
+    """
+    return [arg.format(**kwargs) for arg in shlex.split(template)]
+
+
+class PostSyncRunner:
+    def __init__(self):
+        self.portage_etc_dir = '/etc/portage'
+        self.repos_conf = ''
+        self.state_file = '/var/cache/portagekeeper/postsync.json'
+        self.outdir = './keeper_out'
+        self.command = DEFAULT_COMMAND
+        self.sort_command = DEFAULT_SORT_COMMAND
+        self.skip_repos = ['gentoo']
+        self.jobs = os.cpu_count() or 1
+        self.force = False
+        self._debug = False
+        self.log = logging.getLogger('PostSync')
+
+    def parse_args(self, argv: list = None):
+        ap = argparse.ArgumentParser(description="Post-sync runner: regenerates metadata cache "
+                                     "(or runs any other command) only for repositories that "
+                                     "changed since previous run, several at once, then runs "
+                                     "portagekeeper 'sort' once.")
+        ap.add_argument('--portage_etc_dir', action='store', nargs='?', type=str, default='/etc/portage',
+                        required=False, help='Location of portage configuration, default: /etc/portage')
+        ap.add_argument('--repos_conf', action='store', nargs='?', type=str, default=None,
+                        required=False, help='repos.conf file or directory, default: <portage_etc_dir>/repos.conf')
+        ap.add_argument('--state_file', action='store', nargs='?', type=str, default=self.state_file,
+                        required=False, help='Where to keep repository fingerprints between runs, '
+                        'default: ' + self.state_file)
+        ap.add_argument('--outdir', action='store', nargs='?', type=str, default='./keeper_out',
+                        required=False, help="Where to put result files for action 'sort'")
+        ap.add_argument('--command', action='store', nargs='?', type=str, default=DEFAULT_COMMAND,
+                        required=False, help='Command to run for every changed repository. Placeholders: '
+                        '{name}, {location}, {jobs} (number of CPUs divided by --jobs). '
+                        'Default: ' + DEFAULT_COMMAND.replace('%', '%%'))
+        ap.add_argument('--sort_command', action='store', nargs='?', type=str, default=DEFAULT_SORT_COMMAND,
+                        required=False, help='Command to run once at the end, empty string to disable. '
+                        'Placeholders: {python}, {keeper}, {portage_etc_dir}, {outdir}.')
+        ap.add_argument('--skip', action='store', nargs='*', type=str, default=['gentoo'],
+                        help='Repositories to never run command for, default: gentoo '
+                        '(it comes with pregenerated cache)')
+        ap.add_argument('--jobs', action='store', type=int, default=self.jobs,
+                        help='How many commands to run at once, default: number of CPUs')
+        ap.add_argument('--force', action='store_true', help='Ignore saved fingerprints, process all repositories')
+        ap.add_argument('--debug', action='store_true', help='Enable more debug output')
+        args = ap.parse_args(argv)
+
+        self.portage_etc_dir = args.portage_etc_dir
+        if args.repos_conf is None:
+            args.repos_conf = pathlib.Path(self.portage_etc_dir).joinpath('repos.conf').as_posix()
+        self.repos_conf = args.repos_conf
+        self.state_file = args.state_file
+        self.outdir = args.outdir
+        self.command = args.command
+        self.sort_command = args.sort_command
+        self.skip_repos = args.skip
+        self.jobs = max(1, args.jobs)
+        self.force = args.force
+        self._debug = args.debug
+
+        self.init_logging()
+
+    def init_logging(self):
+        self.log.setLevel(logging.DEBUG)
+        ch = logging.StreamHandler(stream=sys.stdout)
+        if self._debug:
+            ch.setLevel(logging.DEBUG)
+            formatter = logging.Formatter('%(levelname)s [%(funcName)s:%(lineno)d] %(message)s')
+        else:
+            ch.setLevel(logging.INFO)
+            formatter = logging.Formatter('%(levelname)s %(message)s')
+        ch.setFormatter(formatter)
+        self.log.addHandler(ch)
+
+    def load_state(self) -> dict:
+        try:
+            with open(self.state_file, mode='rt', encoding='utf-8') as f:
+                state = json.load(f)
+            if isinstance(state, dict):
+                return state
+        except (IOError, ValueError):
+            self.log.debug('No usable state file: {}'.format(self.state_file))
+        return {}
+
+    def save_state(self, state: dict):
+        p = pathlib.Path(self.state_file)
+        try:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            tmp = p.with_name(p.name + '.tmp')
+            with open(tmp.as_posix(), mode='wt', encoding='utf-8') as f:
+                json.dump(state, f, indent=1, sort_keys=True)
+                f.write('\n')
+            os.replace(tmp.as_posix(), p.as_posix())
+        except IOError:
+            self.log.exception('Failed to write state file: {}'.format(self.state_file))
+
+    def run_command(self, args: list) -> bool:
+        self.log.debug('  Running: {}'.format(' '.join(shlex.quote(a) for a in args)))
+        try:
+            return subprocess.call(args) == 0
+        except OSError:
+            self.log.exception('Failed to run: {}'.format(args[0]))
+            return False
+
+    def command_jobs(self) -> int:
+        """
+        Jobs for each command, so that all commands running at once
+        together do not use more than cpu count.
+        """
+        return max(1, (os.cpu_count() or 1) // self.jobs)
+
+    def run_repo(self, repo: RepoInfo) -> str:
+        """
+        Returns fingerprint of repository after command finished,
+        or empty string if command failed.
+        """
+        self.log.info('Updating repository: {}'.format(repo))
+        args = format_command(self.command, name=repo.name, location=repo.location, jobs=self.command_jobs())
+        if not self.run_command(args):
+            self.log.error('Command failed for repository: {}'.format(repo.name))
+            return ''
+        # command (egencache) may write into repository itself, so
+        #  fingerprint is taken again, after it
+        return repo_fingerprint(pathlib.Path(repo.location))
+
+    def changed_repos(self, repos: list, state: dict) -> list:
+        """
+        Returns list of RepoInfo for repos that need processing.
+        """
+        ret = []
+        for repo in repos:
+            if repo.name in self.skip_repos:
+                self.log.debug('  Skipped repository: {}'.format(repo.name))
+                continue
+            fp = repo_fingerprint(pathlib.Path(repo.location))
+            if fp == '':
+                self.log.warning('Repository location does not exist: {}'.format(repo))
+                continue
+            if not self.force and state.get(repo.name) == fp:
+                self.log.debug('  Unchanged: {} [{}]'.format(repo.name, fp))
+                continue
+            ret.append(repo)
+        return ret
+
+    def run_sort(self) -> bool:
+        if self.sort_command.strip() == '':
+            return True
+        keeper = pathlib.Path(__file__).resolve().parent.joinpath('portagekeeper.py')
+        args = format_command(self.sort_command, python=sys.executable, keeper=keeper.as_posix(),
+                              portage_etc_dir=self.portage_etc_dir, outdir=self.outdir)
+        self.log.info('Running sort')
+        ok = self.run_command(args)
+        if not ok:
+            self.log.error('Sort command failed')
+        return ok
+
+    def run(self) -> bool:
+        repos = read_repos_conf(pathlib.Path(self.repos_conf))
+        if len(repos) == 0:
+            self.log.error('No repositories found in: {}'.format(self.repos_conf))
+            return False
+        state = self.load_state()
+        changed = self.changed_repos(repos, state)
+        self.log.info('Repositories changed: {} of {}'.format(len(changed), len(repos)))
+
+        all_ok = True
+        if len(changed) > 0:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                results = executor.map(self.run_repo, changed)
+                for repo, fp in zip(changed, results):
+                    if fp != '':
+                        # remember only successful ones, failed will be retried next time
+                        state[repo.name] = fp
+                    else:
+                        all_ok = False
+            self.save_state(state)
+
+        if not self.run_sort():
+            all_ok = False
+        return all_ok
+
+
+class PostSyncRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tmpdir.name)
+        self.calls_log = self.root.joinpath('calls.log')
+        self.stub = self.root.joinpath('stub.sh')
+        with open(self.stub.as_posix(), mode='wt', encoding='utf-8') as f:
+            # like egencache, writes into repository (3rd argument) when it is given
+            f.write('#!/bin/sh\necho "$1 $2" >> "{}"\n'
+                    'if [ -n "$3" ]; then\n'
+                    '    mkdir -p "$3/metadata/md5-cache"\n'
+                    '    touch "$3/metadata/md5-cache/entry-$(date +%s%N)"\n'
+                    'fi\n'.format(self.calls_log.as_posix()))
+        self.stub.chmod(0o755)
+        repos_conf = self.root.joinpath('repos.conf')
+        repos_conf.mkdir()
+        with open(repos_conf.joinpath('repos.conf').as_posix(), mode='wt', encoding='utf-8') as f:
+            for name in ['gentoo', 'kde', 'qt']:
+                self.root.joinpath(name, 'metadata').mkdir(parents=True)
+                f.write('[{}]\nlocation = {}\n\n'.format(name, self.root.joinpath(name).as_posix()))
+        self.runner = PostSyncRunner()
+        self.runner.repos_conf = repos_conf.as_posix()
+        self.runner.state_file = self.root.joinpath('state.json').as_posix()
+        self.runner.command = self.stub.as_posix() + ' repo {name} {location}'
+        self.runner.sort_command = self.stub.as_posix() + ' sort'
+        self.runner.jobs = 2
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read_calls(self) -> list:
+        if not self.calls_log.exists():
+            return []
+        with open(self.calls_log.as_posix(), mode='rt', encoding='utf-8') as f:
+            lines = sorted(line.strip() for line in f)
+        self.calls_log.unlink()
+        return lines
+
+    def test_readReposConf(self):
+        repos = read_repos_conf(pathlib.Path(__file__).resolve().parent.joinpath('tests', 'portage', 'repos.conf'))
+        self.assertEqual([r.name for r in repos], ['gentoo', 'kde', 'qt', 'minlexx_overlay'])
+        self.assertEqual(repos[0].location, '/usr/portage-git')
+
+    def test_runOnlyChanged(self):
+        self.assertTrue(self.runner.run())
+        self.assertEqual(self.read_calls(), ['repo kde', 'repo qt', 'sort'])
+        # nothing changed - only sort is run
+        self.assertTrue(self.runner.run())
+        self.assertEqual(self.read_calls(), ['sort'])
+        # add a file to one of repositories
+        self.root.joinpath('qt', 'metadata', 'layout.conf').touch()
+        os.utime(self.root.joinpath('qt', 'metadata').as_posix(), ns=(0, 1))
+        self.assertTrue(self.runner.run())
+        self.assertEqual(self.read_calls(), ['repo qt', 'sort'])
+
+    def test_noRepos(self):
+        self.runner.repos_conf = self.root.joinpath('missing.conf').as_posix()
+        self.assertFalse(self.runner.run())
+        self.assertEqual(self.read_calls(), [])
+
+    def test_commandJobs(self):
+        self.runner.jobs = (os.cpu_count() or 1) + 1
+        self.assertEqual(self.runner.command_jobs(), 1)
+        self.runner.jobs = 1
+        self.assertEqual(self.runner.command_jobs(), os.cpu_count() or 1)
+
+    def test_failedIsRetried(self):
+        self.runner.command = 'false {name}'
+        self.assertFalse(self.runner.run())
+        self.runner.command = self.stub.as_posix() + ' repo {name} {location}'
+        self.assertTrue(self.runner.run())
+        self.assertEqual(self.read_calls(), ['repo kde', 'repo qt', 'sort', 'sort'])
+
+
+def main():
+    runner = PostSyncRunner()
+    runner.parse_args()
+    if not runner.run():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,10 @@
 import argparse
 import pathlib  # Python >= 3.5
 import sys
+import tempfile
+import unittest
 
-
-g_new_files = []
-g_modified_files = []
-
-
-def add_modified_file(fn: str) -> None:
-    global g_modified_files
-    if fn not in g_modified_files:
-        g_modified_files.append(fn)
-
-
-def add_new_file(fn: str) -> None:
-    global g_new_files
-    if fn not in g_new_files:
-        g_new_files.append(fn)
+from keeper_transaction import Transaction
 
 
 def get_existing_useflags(in_file: pathlib.Path, pn: str) -> list:
@@ -43,89 +31,31 @@ def get_existing_useflags(in_file: pathlib.Path, pn: str) -> list:
     return ret
 
 
-def file_write_lines(out_file: pathlib.Path, lines: list) -> bool:
-    try:
-        with open(str(out_file), mode='wt', encoding='utf-8') as f:
-            # f.writelines(existing_lines) # does not add '\n's
-            for line in lines:
-                f.write(line)
-                f.write('\n')
-            f.close()
-    except IOError:
-        print('ERROR: Failed to write file: {}\n'.format(str(out_file)), file=sys.stderr)
-        return False
-    return True
-
-
-def write_useflags(out_dir: pathlib.Path,
+def write_useflags(txn: Transaction,
                    category: str,
                    package: str,
                    useflags: list,
                    no_overwrite_mode: bool = False) -> None:
-    global g_new_files
-    global g_modified_files
-
-    out_file = out_dir / category
-    out_file2 = out_dir / ("._cfg0000_" + category)
-
-    # destination file may exist; read/save its contents first
-    existing_lines = []
-
-    # ._cfg0000_* file may exist at this point;
-    #   if it is, then we should read existing lines from it
-    if out_file2.exists():
-        with open(str(out_file2), mode='rt', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if len(line) < 1:  # skip empty lines
-                    continue
-                if line[0] == '#':  # skip comments
-                    continue
-                existing_lines.append(line)
-            f.close()
-    elif out_file.exists():
-        with open(str(out_file), mode='rt', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if len(line) < 1:  # skip empty lines
-                    continue
-                if line[0] == '#':  # skip comments
-                    continue
-                existing_lines.append(line)
-            f.close()
-        if no_overwrite_mode:
-            # Do not overwite file, create a new file with ".new" suffix instead
-            out_file = out_dir / (category + '.new')
-            add_new_file(str(out_file))
-        else:
-            add_modified_file(str(out_file))
-    else:
-        add_new_file(str(out_file))
-
-    # existing_lines contain lines in the following format:
+    out_name = category
+    out_name2 = "._cfg0000_" + category
+
+    # Which files exist is decided when transaction is committed, under lock:
+    # ._cfg0000_* file may exist at that point;
+    #   if it is, then existing lines are read from it, else from destination file.
+    bases = [out_name2, out_name]
+    new_name = None
+    if no_overwrite_mode:
+        # Do not overwite existing file, create a new file with ".new" suffix instead
+        new_name = category + '.new'
+
+    # resulting lines are in the following format:
     #  <category/package> <use flags separated by spaces ...>
     package_name = '{}/{}'.format(category, package)
-    new_line = '{} {}'.format(package_name, ' '.join(useflags))
+    txn.set_useflags(out_name, package_name, useflags, bases, new_name)
+    txn.set_useflags(out_name2, package_name, useflags, bases)
 
-    # find package line in existing lines
-    found = False
-    for i in range(len(existing_lines)):
-        if existing_lines[i].startswith(package_name):
-            found = True
-            existing_lines[i] = new_line
-            break
-    if not found:
-        existing_lines.append(new_line)
 
-    # sort them
-    existing_lines = sorted(existing_lines)
-
-    # finally write them
-    file_write_lines(out_file, existing_lines)
-    file_write_lines(out_file2, existing_lines)
-
-
-def add_useflag(in_dir: pathlib.Path, out_dir: pathlib.Path, pn: str, useflag: str) -> None:
+def add_useflag(txn: Transaction, in_dir: pathlib.Path, out_dir: pathlib.Path, pn: str, useflag: str) -> None:
     no_overwrite_mode = str(in_dir) == str(out_dir)
     parts = pn.split('/')
     if len(parts) < 2:
@@ -143,7 +73,52 @@ def add_useflag(in_dir: pathlib.Path, out_dir: pathlib.Path, pn: str, useflag: s
         mergedlist.append(useflag)
 
     newuse = sorted(mergedlist)
-    write_useflags(out_dir, category, package, newuse, no_overwrite_mode)
+    write_useflags(txn, category, package, newuse, no_overwrite_mode)
+
+
+class UseFixerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = pathlib.Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self, filename: str) -> str:
+        with open(str(self.root / filename), mode='rt', encoding='utf-8') as f:
+            return f.read()
+
+    def add(self, pn: str, useflag: str) -> Transaction:
+        # in-place (no-overwrite) mode, like run without --out-dir
+        txn = Transaction(self.root)
+        add_useflag(txn, self.root, self.root, pn, useflag)
+        txn.queue()
+        return txn
+
+    def test_concurrentCallers(self):
+        # two callers queue before either commits
+        t1 = self.add('media-libs/mesa', 'xa')
+        t2 = self.add('media-libs/flac', 'cxx')
+        self.assertEqual(t1.commit(), {'media-libs': True, '._cfg0000_media-libs': True})
+        # third caller comes after file was created
+        t3 = self.add('media-libs/opus', 'custom-modes')
+        self.assertEqual(t3.commit(), {'media-libs.new': True, '._cfg0000_media-libs': False})
+        self.assertEqual(t2.commit(), {})
+        self.assertTrue(t2.applied_by_other)
+        self.assertEqual(self.read('media-libs'), 'media-libs/flac cxx\nmedia-libs/mesa xa\n')
+        expected = 'media-libs/flac cxx\nmedia-libs/mesa xa\nmedia-libs/opus custom-modes\n'
+        self.assertEqual(self.read('media-libs.new'), expected)
+        self.assertEqual(self.read('._cfg0000_media-libs'), expected)
+
+    def test_noOverwrite(self):
+        with open(str(self.root / 'media-libs'), mode='wt', encoding='utf-8') as f:
+            f.write('# for mpv\nmedia-libs/libvpx postproc\n')
+        self.add('media-libs/libvpx', 'svc').commit()
+        self.add('media-libs/mesa', 'xa').commit()
+        self.assertEqual(self.read('media-libs'), '# for mpv\nmedia-libs/libvpx postproc\n')
+        expected = '# for mpv\nmedia-libs/libvpx postproc svc\nmedia-libs/mesa xa\n'
+        self.assertEqual(self.read('media-libs.new'), expected)
+        self.assertEqual(self.read('._cfg0000_media-libs'), expected)
 
 
 def main():
@@ -183,6 +158,10 @@ def main():
     if str(in_dir) == str(out_dir):
         print('Input and output directories are the same, will use no-overwrite mode')
 
+    # all changes are collected first and then applied at once; concurrent
+    #  runs against the same out_dir are merged together
+    txn = Transaction(out_dir)
+
     try:
         with open(args.in_file, mode='rt', encoding='utf-8') as f:
             print('Opened input file with flags:', args.in_file)
@@ -198,24 +177,34 @@ def main():
                 pn = parts[0]
                 useflag = parts[1]
 
-                add_useflag(in_dir, out_dir, pn, useflag)
+                add_useflag(txn, in_dir, out_dir, pn, useflag)
             f.close()
-
-        # Output some statistics
-        global g_new_files
-        global g_modified_files
-
-        print('Modified files ({}): '.format(len(g_modified_files)))
-        for s in g_modified_files:
-            print('    {}'.format(s))
-        print('New files ({}): '.format(len(g_new_files)))
-        for s in g_new_files:
-            print('    {}'.format(s))
-        
-        print('Please run etc-update or dispatch-conf to apply configuration changes.')
-        print('(Also remove all /etc/portage/package.use/*.new files)')
     except IOError:
         print('ERROR: Failed to open input file with flags:', args.in_file, file=sys.stderr)
+        return
+
+    try:
+        written = txn.commit()
+    except (IOError, ValueError):
+        print('ERROR: Failed to apply changes to:', str(out_dir), file=sys.stderr)
+        return
+
+    if txn.applied_by_other:
+        print('Changes were applied together with those of a concurrent run, see its output')
+
+    # Output some statistics
+    modified_files = [str(out_dir / fn) for fn in written if not written[fn] and not fn.startswith('.')]
+    new_files = [str(out_dir / fn) for fn in written if written[fn] and not fn.startswith('.')]
+
+    print('Modified files ({}): '.format(len(modified_files)))
+    for s in modified_files:
+        print('    {}'.format(s))
+    print('New files ({}): '.format(len(new_files)))
+    for s in new_files:
+        print('    {}'.format(s))
+
+    print('Please run etc-update or dispatch-conf to apply configuration changes.')
+    print('(Also remove all /etc/portage/package.use/*.new files)')
 
 
 if __name__ == '__main__':